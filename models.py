@@ -11,12 +11,12 @@ from torchvision import utils, transforms as T
 
 from torch.optim import Adam
 
-from einops import rearrange, reduce
+from einops import rearrange
 
 from tqdm import tqdm
 
 from denoising_diffusion_pytorch import GaussianDiffusion, Trainer
-from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Dataset
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import Dataset, ModelPrediction
 
 from deep_image_prior.utils.denoising_utils import *
 
@@ -38,15 +38,21 @@ def cycle(dl):
             yield data
 
 def has_int_squareroot(num):
-    return (math.sqrt(num) ** 2) == num
+    r = math.isqrt(num)
+    return r * r == num
 
 def num_to_groups(num, divisor):
-    groups = num // divisor
-    remainder = num % divisor
-    arr = [divisor] * groups
-    if remainder > 0:
-        arr.append(remainder)
-    return arr
+    groups, remainder = divmod(num, divisor)
+    return [divisor] * groups + ([remainder] if remainder else [])
+
+def enable_fast_matmul():
+    # free throughput on ampere+ gpus: tf32 matmuls/convs and cudnn autotuning
+    # for the fixed conv shapes used throughout training and sampling
+    if torch.cuda.is_available():
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
 
 def convert_image_to_fn(img_type, image):
     if image.mode != img_type:
@@ -55,15 +61,17 @@ def convert_image_to_fn(img_type, image):
 
 def extract(a, t, x_shape):
     b, *_ = t.shape
-    out = a.gather(-1, t)
-    return out.reshape(b, *((1,) * (len(x_shape) - 1)))
+    return a[t].view(b, *((1,) * (len(x_shape) - 1)))
 
 def standardizing(x):
-    return (x - torch.mean(x)) / torch.std(x)
+    std, mean = torch.std_mean(x)
+    return (x - mean) / std
 
 def collate_fn(batch):
     data, noise = zip(*batch)
-    return torch.stack(data), torch.stack(noise)
+    data = torch.stack(data).contiguous(memory_format = torch.channels_last)
+    noise = torch.stack(noise).contiguous(memory_format = torch.channels_last)
+    return data, noise
 
 def generate_noise(dip_model,
                    dip_input_depth,
@@ -123,22 +131,71 @@ class GaussianDiffusionWithDeepImagePrior(GaussianDiffusion):
         
         self.dip_model = dip_model
         self.dip_input_depth = dip_input_depth
-        self.dip_input = get_noise(self.dip_input_depth, 'noise', self.image_size)
+
+        # registered as a buffer so it follows the module to the right device once,
+        # instead of paying a host-to-device copy on every step
+
+        self.register_buffer('dip_input', get_noise(self.dip_input_depth, 'noise', self.image_size), persistent = False)
+
+    @torch.inference_mode()
+    def _dip_forward(self, batch):
+        # one gradient-free dip forward per sampling call, shared by both loops;
+        # no caching across calls, since ema updates move the weights without any
+        # reliable signal to invalidate on
+
+        return standardizing(self.dip_model(self.dip_input)).expand(batch, -1, -1, -1)
+
+    def model_predictions(self, x, t, x_self_cond = None, clip_x_start = False, rederive_pred_noise = False):
+        # one u-net forward, then both predictions derived analytically from the
+        # objective; pred_noise is only computed once, from the clipped x_start,
+        # instead of being derived and then rederived
+
+        model_output = self.model(x, t, x_self_cond)
+
+        if self.objective == 'pred_noise':
+            pred_noise = model_output
+            x_start = self.predict_start_from_noise(x, t, pred_noise)
+            if clip_x_start:
+                x_start = torch.clamp(x_start, min = -1., max = 1.)
+                if rederive_pred_noise:
+                    pred_noise = self.predict_noise_from_start(x, t, x_start)
+
+        elif self.objective == 'pred_x0':
+            x_start = model_output
+            if clip_x_start:
+                x_start = torch.clamp(x_start, min = -1., max = 1.)
+            pred_noise = self.predict_noise_from_start(x, t, x_start)
+
+        elif self.objective == 'pred_v':
+            x_start = self.predict_start_from_v(x, t, model_output)
+            if clip_x_start:
+                x_start = torch.clamp(x_start, min = -1., max = 1.)
+            pred_noise = self.predict_noise_from_start(x, t, x_start)
+
+        else:
+            raise ValueError(f'unknown objective {self.objective}')
+
+        return ModelPrediction(pred_noise, x_start)
 
     @torch.inference_mode()
     def p_sample_loop(self, shape, return_all_timesteps = False):
         batch, device = shape[0], self.device
 
-        img = self.dip_model(self.dip_input.to(self.device))
-        img = standardizing(img).expand(batch, -1, -1, -1)
-        imgs = [img]
+        img = self._dip_forward(batch)
+
+        # only keep the intermediate images alive when the caller wants them,
+        # otherwise the allocator can reuse the buffers every step
+
+        imgs = [img] if return_all_timesteps else None
 
         x_start = None
 
         for t in tqdm(reversed(range(0, self.num_timesteps)), desc = 'sampling loop time step', total = self.num_timesteps, leave = False):
             self_cond = x_start if self.self_condition else None
-            img, x_start = self.p_sample(img, t, self_cond)
-            imgs.append(img)
+            with torch.autocast(device_type = device.type, dtype = torch.bfloat16, enabled = device.type == 'cuda'):
+                img, x_start = self.p_sample(img, t, self_cond)
+            if return_all_timesteps:
+                imgs.append(img)
 
         ret = img if not return_all_timesteps else torch.stack(imgs, dim = 1)
 
@@ -153,35 +210,43 @@ class GaussianDiffusionWithDeepImagePrior(GaussianDiffusion):
         times = list(reversed(times.int().tolist()))
         time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
 
-        img = self.dip_model(self.dip_input.to(self.device))
-        img = standardizing(img).expand(batch, -1, -1, -1)
-        imgs = [img]
+        # precompute the whole schedule on device so the loop only indexes into it,
+        # instead of allocating a fresh time tensor and re-gathering alphas per step
+
+        times_t = torch.tensor(times[:-1], device = device, dtype = torch.long)
+        times_next_t = torch.tensor(times[1:], device = device, dtype = torch.long)
+
+        alphas = self.alphas_cumprod.index_select(0, times_t)
+        alphas_next = torch.where(times_next_t < 0, torch.ones_like(alphas), self.alphas_cumprod.index_select(0, times_next_t.clamp(min = 0)))
+
+        sigmas = eta * ((1 - alphas / alphas_next) * (1 - alphas_next) / (1 - alphas)).sqrt()
+        cs = (1 - alphas_next - sigmas ** 2).sqrt()
+
+        img = self._dip_forward(batch)
+        imgs = [img] if return_all_timesteps else None
 
         x_start = None
 
-        for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step', leave = False):
-            time_cond = torch.full((batch,), time, device = device, dtype = torch.long)
+        for i, (time, time_next) in tqdm(enumerate(time_pairs), desc = 'sampling loop time step', total = len(time_pairs), leave = False):
+            time_cond = times_t[i].expand(batch)
             self_cond = x_start if self.self_condition else None
-            pred_noise, x_start, *_ = self.model_predictions(img, time_cond, self_cond, clip_x_start = True, rederive_pred_noise = True)
+            with torch.autocast(device_type = device.type, dtype = torch.bfloat16, enabled = device.type == 'cuda'):
+                pred_noise, x_start, *_ = self.model_predictions(img, time_cond, self_cond, clip_x_start = True, rederive_pred_noise = True)
 
             if time_next < 0:
                 img = x_start
-                imgs.append(img)
+                if return_all_timesteps:
+                    imgs.append(img)
                 continue
 
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
-
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
-
             noise = torch.randn_like(img)
 
-            img = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
+            img = x_start * alphas_next[i].sqrt() + \
+                  cs[i] * pred_noise + \
+                  sigmas[i] * noise
 
-            imgs.append(img)
+            if return_all_timesteps:
+                imgs.append(img)
 
         ret = img if not return_all_timesteps else torch.stack(imgs, dim = 1)
 
@@ -194,10 +259,12 @@ class GaussianDiffusionWithDeepImagePrior(GaussianDiffusion):
         sample_fn = self.p_sample_loop if not self.is_ddim_sampling else self.ddim_sample
         return sample_fn((batch_size, channels, h, w), return_all_timesteps = return_all_timesteps)
 
-    def p_losses(self, x_start, t, noise = None, offset_noise_strength = None):
+    def p_losses(self, x_start, t, noise = None, offset_noise_strength = None, use_self_cond = None):
         b, c, h, w = x_start.shape
+
+        use_self_cond = default(use_self_cond, lambda: self.self_condition and random() < 0.5)
         
-        dip_out = self.dip_model(self.dip_input.to(self.device)).expand(b, -1, -1, -1)
+        dip_out = self.dip_model(self.dip_input).expand(b, -1, -1, -1)
 
         noise = default(noise, lambda: standardizing(dip_out - x_start))
 
@@ -218,7 +285,7 @@ class GaussianDiffusionWithDeepImagePrior(GaussianDiffusion):
         # this technique will slow down training by 25%, but seems to lower FID significantly
 
         x_self_cond = None
-        if self.self_condition and random() < 0.5:
+        if use_self_cond:
             with torch.no_grad():
                 x_self_cond = self.model_predictions(x, t).pred_x_start
                 x_self_cond.detach_()
@@ -237,13 +304,11 @@ class GaussianDiffusionWithDeepImagePrior(GaussianDiffusion):
         else:
             raise ValueError(f'unknown objective {self.objective}')
 
-        loss = F.mse_loss(model_out, target, reduction = 'none')
-        loss = reduce(loss, 'b ... -> b', 'mean')
+        loss = (model_out - target).pow(2).mean(dim = (1, 2, 3))
 
         loss = loss * extract(self.loss_weight, t, loss.shape)
-        
-        dip_loss = F.mse_loss(dip_out, x_start)
-        dip_loss = dip_loss.mean() / b * self.loss_weight[-1]
+
+        dip_loss = (dip_out - x_start).pow(2).mean() / b * self.loss_weight[-1]
 
         return loss.mean() + dip_loss
 
@@ -252,7 +317,12 @@ class GaussianDiffusionWithDeepImagePrior(GaussianDiffusion):
         assert h == img_size[0] and w == img_size[1], f'height and width of image must be {img_size}'
         t = torch.randint(0, self.num_timesteps, (b,), device=device).long()
 
-        img = self.normalize(img)
+        img = self.normalize(img).contiguous(memory_format = torch.channels_last)
+
+        # draw the self-conditioning branch on the host here, before the hot path,
+        # so dynamo specializes on a plain bool instead of hitting a graph break
+
+        kwargs.setdefault('use_self_cond', self.self_condition and random() < 0.5)
         return self.p_losses(img, t, *args, **kwargs)
 
 
@@ -264,7 +334,8 @@ class DatasetwithNoise(Dataset):
         image_size,
         exts = ['jpg', 'jpeg', 'png', 'tiff'],
         augment_horizontal_flip = False,
-        convert_image_to = None
+        convert_image_to = None,
+        max_preload_bytes = 4 * 1024 ** 3
     ):
         super().__init__(folder,
                          image_size,
@@ -274,6 +345,25 @@ class DatasetwithNoise(Dataset):
         )
         self.noise_folder = noise_folder
 
+        # preload every noise tensor once so __getitem__ skips a file read per
+        # sample per epoch; fall back to per-sample loading when the stack would
+        # not comfortably fit in memory
+
+        self.noises = None
+        if len(self.paths) > 0:
+            first = self._load_noise(self.paths[0])
+            if first.numel() * first.element_size() * len(self.paths) <= max_preload_bytes:
+                self.noises = torch.stack([first, *(self._load_noise(path) for path in self.paths[1:])])
+
+                # move the stack into shared memory so dataloader workers index into
+                # the same pages instead of each inheriting a private copy
+
+                self.noises.share_memory_()
+
+    def _load_noise(self, path):
+        noise_path = os.path.join(self.noise_folder, f'{path.stem}.pth')
+        return torch.load(noise_path, map_location = 'cpu', weights_only = True)
+
     def __len__(self):
         return len(self.paths)
 
@@ -281,10 +371,9 @@ class DatasetwithNoise(Dataset):
         path = self.paths[index]
         img = Image.open(path)
         data = self.transform(img)
-        noise_path = os.path.join(self.noise_folder, f'{path.stem}.pth')
-        noise = torch.load(noise_path)
+        noise = self.noises[index] if self.noises is not None else self._load_noise(path)
         assert data.shape == noise.shape, 'data and noise must have the same shape'
-        return data, noise
+        return data, noise.float()
 
 
 class Trainer(Trainer):
@@ -316,6 +405,8 @@ class Trainer(Trainer):
         num_fid_samples = 50000,
         save_best_and_latest_only = False
     ):
+        enable_fast_matmul()
+
         super().__init__(
             diffusion_model,
             folder,
@@ -347,12 +438,28 @@ class Trainer(Trainer):
 
         self.ds_noise = DatasetwithNoise(folder, noise_folder, self.image_size, augment_horizontal_flip = augment_horizontal_flip, convert_image_to = convert_image_to)
         
-        dl_noise = DataLoader(self.ds_noise, batch_size = train_batch_size, shuffle = True, pin_memory = True, num_workers = cpu_count(), collate_fn = collate_fn)
+        dl_noise = DataLoader(self.ds_noise, batch_size = train_batch_size, shuffle = True, pin_memory = True, num_workers = min(8, max(1, cpu_count() // 2)), persistent_workers = True, prefetch_factor = 4, collate_fn = collate_fn)
         
         dl_noise = self.accelerator.prepare(dl_noise)
 
         self.dl_noise = cycle(dl_noise)
 
+        # nhwc layout lets cudnn/inductor pick tensor-core friendly conv kernels
+
+        diffusion_model.model.to(memory_format = torch.channels_last)
+        if hasattr(diffusion_model, 'dip_model'):
+            diffusion_model.dip_model.to(memory_format = torch.channels_last)
+
+        # compile the hot forward paths - the u-net (and dip model when present) is called
+        # thousands of times with identical shapes, so cuda graph capture pays off.
+        # compile the bound forward rather than swapping in an OptimizedModule:
+        # the ema keeps matching parameters by name and checkpoint keys stay stable
+
+        if torch.cuda.is_available():
+            diffusion_model.model.forward = torch.compile(diffusion_model.model.forward, mode = 'reduce-overhead', fullgraph = False, dynamic = False)
+            if hasattr(diffusion_model, 'dip_model'):
+                diffusion_model.dip_model.forward = torch.compile(diffusion_model.dip_model.forward, mode = 'reduce-overhead')
+
     def train(self):
         accelerator = self.accelerator
         device = accelerator.device
@@ -365,8 +472,8 @@ class Trainer(Trainer):
 
                 for _ in range(self.gradient_accumulate_every):
                     data, noise = next(self.dl_noise)
-                    data = data.to(device)
-                    noise = noise.to(device)
+                    data = data.to(device, non_blocking = True)
+                    noise = noise.to(device, non_blocking = True)
                     randn = torch.randn_like(noise, device = device)
 
                     with self.accelerator.autocast():
@@ -383,7 +490,7 @@ class Trainer(Trainer):
                 accelerator.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
 
                 self.opt.step()
-                self.opt.zero_grad()
+                self.opt.zero_grad(set_to_none = True)
 
                 accelerator.wait_for_everyone()
 
@@ -394,12 +501,20 @@ class Trainer(Trainer):
                     if self.step != 0 and divisible_by(self.step, self.save_and_sample_every):
                         self.ema.ema_model.eval()
 
-                        with torch.inference_mode():
+                        with torch.inference_mode(), self.accelerator.autocast():
                             milestone = self.step // self.save_and_sample_every
                             batches = num_to_groups(self.num_samples, self.batch_size)
-                            all_images_list = list(map(lambda n: self.ema.ema_model.sample(batch_size=n), batches))
 
-                        all_images = torch.cat(all_images_list, dim = 0)
+                            # write each sampled batch straight into one preallocated
+                            # buffer rather than collecting a list and torch.cat-ing it
+
+                            samples = self.ema.ema_model.sample(batch_size = batches[0])
+                            all_images = torch.empty((self.num_samples, *samples.shape[1:]), device = samples.device, dtype = samples.dtype)
+                            all_images[:batches[0]] = samples
+                            offset = batches[0]
+                            for n in batches[1:]:
+                                all_images[offset:offset + n] = self.ema.ema_model.sample(batch_size = n)
+                                offset += n
 
                         utils.save_image(all_images, str(self.results_folder / f'sample-{milestone}.png'), nrow = int(math.sqrt(self.num_samples)))
 
@@ -434,23 +549,43 @@ class DIPTrainer:
         results_folder = './results',
         device = None
     ):
+        enable_fast_matmul()
+
         self.device = default(device, torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
-        self.dtype = torch.FloatTensor
-        
-        self.model = model.type(self.dtype).to(self.device)
+
+        self.model = model.to(self.device, memory_format = torch.channels_last)
+        if self.device.type == 'cuda':
+            # image sizes vary per training image, so cuda graph capture
+            # ('reduce-overhead') would recompile per image; autotuned triton
+            # kernels without graphs handle the varying shapes better. compiling
+            # the bound forward keeps state_dict keys loadable on cpu-only hosts
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+            self.model.forward = torch.compile(self.model.forward, mode = 'max-autotune-no-cudagraphs', dynamic = True, fullgraph = False)
         self.dip_input_depth = dip_input_depth
-        self.train_img = self._load_image(train_img).type(self.dtype).to(self.device)
+        self.train_img = self._load_image(train_img).to(self.device, dtype = torch.float32)
         self.result_folder = results_folder
         self.image_size = self.train_img.shape[-2:]
 
         # optimizer
 
-        self.opt = Adam(self.model.parameters(), lr = learning_rate, betas = adam_betas)
+        self.opt = Adam(self.model.parameters(), lr = learning_rate, betas = adam_betas, fused = self.device.type == 'cuda')
         
-        self.model_input = get_noise(self.dip_input_depth, 'noise', self.image_size).to(self.device)
+        os.makedirs(self.result_folder, exist_ok=True)
+
+        # one canonical input noise per (depth, h, w) is enough - persist it so the
+        # many trainers created by generate_noise share a single tensor instead of
+        # each synthesizing their own
+
+        h, w = self.image_size
+        cache_path = os.path.join(self.result_folder, f'model_input_{self.dip_input_depth}_{h}_{w}.pt')
+        if os.path.exists(cache_path):
+            self.model_input = torch.load(cache_path, map_location = self.device, weights_only = True)
+        else:
+            self.model_input = get_noise(self.dip_input_depth, 'noise', self.image_size).to(self.device)
+            torch.save(self.model_input.cpu(), cache_path)
+        self.model_input = self.model_input.contiguous(memory_format = torch.channels_last)
 
         self.step = 0
-        os.makedirs(self.result_folder, exist_ok=True)
     
     def _load_image(self, train_img):
         if isinstance(train_img, str):
@@ -462,7 +597,7 @@ class DIPTrainer:
             train_img = np_to_torch(train_img)
         if not isinstance(train_img, torch.Tensor):
             raise ValueError('train_img must be a string, image, numpy array or torch tensor')
-        return train_img
+        return train_img.contiguous(memory_format = torch.channels_last)
     
     def save(self, milestone):
         data = {
@@ -501,8 +636,10 @@ class DIPTrainer:
         return noise.detach()
     
     def save_noise(self, filename):
+        # the noise is standardized gaussian, so fp16 range is ample - halves
+        # both the disk footprint and the dataloader's read bandwidth
         noise = self.generate_noise().cpu()[0]
-        torch.save(noise, os.path.join(self.result_folder, filename))
+        torch.save(noise.half(), os.path.join(self.result_folder, filename))
     
     def show_noise(self):
         noise = self.generate_noise()
@@ -515,7 +652,7 @@ class DIPTrainer:
         with tqdm(initial = self.step, total = train_num_steps, leave = False) as pbar:
             while self.step < train_num_steps:
                 self.model.train()
-                self.opt.zero_grad()
+                self.opt.zero_grad(set_to_none = True)
                 output = self.model(self.model_input)
                 loss = F.mse_loss(output, self.train_img)
                 loss.backward()